@@ -1,15 +1,31 @@
+import calendar
+import multiprocessing
+import os
 import re
 import shutil
 import subprocess
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from string import Template
 from typing import Literal
 
 from globals import *
-from md2tex import md2tex
+from md2tex import (
+    UNCAPTIONED_IMAGE,
+    caption_images,
+    load_image_hashes,
+    md2tex_batch,
+    precompute_image_hashes,
+    resolve_image,
+)
 from tqdm import tqdm
-from yaml import Loader, load
+from yaml import load
+
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
+    logger.warning("libyaml is unavailable, falling back to the pure Python loader")
 
 
 class CommandBuilder:
@@ -46,24 +62,49 @@ class CommandBuilder:
         )
 
 
+TIME_24H = re.compile(r"^(\d{1,2}):(\d{2})$")
+TIME_12H = re.compile(r"^(\d{1,2}):(\d{2})\s*([AP]M)$", re.IGNORECASE)
+DATE = re.compile(r"^(\d{4})-(\d{1,2})-(\d{1,2})$")
+MONTHS = (
+    "January",
+    "February",
+    "March",
+    "April",
+    "May",
+    "June",
+    "July",
+    "August",
+    "September",
+    "October",
+    "November",
+    "December",
+)
+
+
 def convert_time(time: str) -> str:
     """
     Convert a time string, either in 24-hour or 12-hour format, to a 12-hour format
     """
-    result: str
-    if re.match(r"^\d{1,2}:\d{2}$", time):
-        result = datetime.strptime(time, "%H:%M").strftime("%-I:%M %p")
-    else:
-        time = re.sub(r"(\d{1,2}):(\d{2})\s*([AP]M)", r"\1:\2 \3", time)
-        result = datetime.strptime(time, "%I:%M %p").strftime("%-I:%-M %p")
-    return result
+    if match := TIME_24H.match(time):
+        hour, minute = int(match[1]), match[2]
+        if hour < 24 and int(minute) < 60:
+            return f"{hour % 12 or 12}:{minute} {'AM' if hour < 12 else 'PM'}"
+    elif match := TIME_12H.match(time):
+        hour, minute = int(match[1]), match[2]
+        if 1 <= hour <= 12 and int(minute) < 60:
+            return f"{hour}:{minute} {match[3].upper()}"
+    raise ValueError(f'Invalid time "{time}"')
 
 
 def convert_date(date: str) -> str:
     """
     Convert a date string to a date string.
     """
-    return datetime.strptime(date, "%Y-%m-%d").strftime("%B %-d, %Y")
+    if (match := DATE.match(date)) and 1 <= (month := int(match[2])) <= 12:
+        year, day = int(match[1]), int(match[3])
+        if 1 <= day <= calendar.monthrange(year, month)[1]:
+            return f"{MONTHS[month - 1]} {day}, {match[1]}"
+    raise ValueError(f'Invalid date "{date}"')
 
 
 def convert_list(l: list) -> str:
@@ -71,7 +112,7 @@ def convert_list(l: list) -> str:
     Convert a list of string to a string.
     """
 
-    l = [str(i) for i in l]
+    l = list(map(str, l))
     if len(l) == 1:
         return l[0]
     elif len(l) == 2:
@@ -89,11 +130,9 @@ def itemizer(l: list) -> str:
     Convert a list of string tp \itemize environment
     """
 
-    return (
-        "\\begin{itemize}\n"
-        + "\n".join((r"\item " + i).strip() for i in l)
-        + "\n\\end{itemize}"
-    )
+    if not l:
+        return ""
+    return "\\begin{itemize}\n\\item " + "\n\\item ".join(l) + "\n\\end{itemize}"
 
 
 def enumerater(l: list) -> str:
@@ -101,26 +140,21 @@ def enumerater(l: list) -> str:
     Convert a list of string tp \enumerate environment
     """
 
-    return (
-        "\\begin{enumerate}\n"
-        + "\n".join((r"\item " + i).strip() for i in l)
-        + "\n\\end{enumerate}"
-    )
+    if not l:
+        return ""
+    return "\\begin{enumerate}\n\\item " + "\n\\item ".join(l) + "\n\\end{enumerate}"
 
 
 def render_work_meet(content: Path) -> str:
     result = []
     with open(content) as f:
-        data = load(f.read(), Loader=Loader)
-    result.append(
-        Template(r"\meeting{$date}{$duration}").substitute(
-            date=convert_date(content.stem),
-            duration="--".join(convert_time(data["time"][e]) for e in ["start", "end"]),
-        )
-    )
-    subsection = lambda *args, **kwargs: Template(
-        "\\subsection{$title}\n\n$body"
-    ).substitute(*args, **kwargs)
+        data = load(f, Loader=Loader)
+    date = convert_date(content.stem)
+    duration = "--".join(convert_time(data["time"][e]) for e in ["start", "end"])
+    result.append(f"\\meeting{{{date}}}{{{duration}}}")
+
+    def subsection(title: str, body: str) -> str:
+        return f"\\subsection{{{title}}}\n\n{body}"
 
     result.append(
         subsection(
@@ -128,18 +162,33 @@ def render_work_meet(content: Path) -> str:
             body=convert_list(data["members"]),
         )
     )
+    # render every markdown fragment of the entry in a single pandoc run
+    goals = data["goal"]
+    overview = data["description"]
+    overview_md = (
+        [overview]
+        if isinstance(overview, str)
+        else [e["description"] for e in overview]
+    )
+    struggles = data.get("struggles") or []
+    struggles_md = [md for e in struggles for md in (e["description"], e["solution"])]
+    rendered = md2tex_batch([*goals, *overview_md, *struggles_md, data["reflection"]])
+    goals_tex, rendered = rendered[: len(goals)], rendered[len(goals) :]
+    overview_tex, rendered = rendered[: len(overview_md)], rendered[len(overview_md) :]
+    struggles_tex, reflection_tex = rendered[:-1], rendered[-1]
+
     result.append(
         subsection(
             title="Goal",
-            body=itemizer(md2tex(x) for x in data["goal"]),
+            body=itemizer([tex.rstrip() for tex in goals_tex]),
         )
     )
     result.append(
         subsection(
             title="Overview",
             body=(
-                md2tex(overview)
-                if isinstance(overview := data["description"], str)
+                overview_tex[0]
+                if isinstance(overview, str)
                 else "\n\n".join(
                     repr(
                         CommandBuilder("work")
@@ -148,40 +197,72 @@ def render_work_meet(content: Path) -> str:
                         .optional_if("0pt", i == 0)
                     )
                     + "\n"
-                    + md2tex(e["description"])
-                    for i, e in enumerate(overview)
+                    + tex
+                    for i, (e, tex) in enumerate(zip(overview, overview_tex))
                 )
             ),
         )
     )
-    if struggles := data.get("struggles"):
+    if struggles:
         result.append(
             subsection(
                 title="Struggles",
                 body="\n\n".join(
-                    Template(
-                        "\\begin{struggle}\n"
-                        "$problem\n"
-                        "\\tcblower\n\n"
-                        "$solution"
-                        "\\end{struggle}\n"
-                    ).substitute(
-                        problem=md2tex(e["description"]),
-                        solution=md2tex(e["solution"]),
+                    "\\begin{struggle}\n"
+                    f"{problem}\n"
+                    "\\tcblower\n\n"
+                    f"{solution}"
+                    "\\end{struggle}\n"
+                    for problem, solution in zip(
+                        struggles_tex[::2], struggles_tex[1::2]
                     )
-                    for e in struggles
                 ),
             )
         )
     result.append(
         subsection(
             title="Reflection",
-            body=md2tex(data["reflection"]),
+            body=reflection_tex,
         )
     )
     return "\n\n".join(result) + "\\newpage"
 
 
+def fragment_path(entry: Path) -> Path:
+    return fragment_dir / (entry.stem + ".tex")
+
+
+def is_stale(entry: Path, code_mtime: float) -> bool:
+    """
+    Whether the fragment of a logbook entry has to be rendered again. Generated
+    captions end up in the fragment, so uncaptioned images count as sources too.
+    """
+
+    if not (fragment := fragment_path(entry)).exists():
+        return True
+    rendered = fragment.stat().st_mtime
+    if rendered < max(entry.stat().st_mtime, code_mtime):
+        return True
+    return any(
+        not image_path.exists() or image_path.stat().st_mtime > rendered
+        for image_path in map(
+            resolve_image, UNCAPTIONED_IMAGE.findall(entry.read_text())
+        )
+    )
+
+
+def render_fragment(entry: Path):
+    """
+    Render a logbook entry into its cached fragment
+    """
+
+    # write atomically, a truncated fragment would otherwise look up to date
+    fragment = fragment_path(entry)
+    tmp = fragment.with_suffix(".tmp")
+    tmp.write_text(render_work_meet(entry))
+    tmp.replace(fragment)
+
+
 def main():
     shutil.copy(
         template_dir / "main.tex",
@@ -189,15 +270,41 @@ def main():
     )
 
     logbook = build_dir / "logbook.tex"
-    with open(logbook, "w") as f:
-        for entry in (
-            pbar := tqdm(
-                sorted(list((doc_dir / "log" / "work_meet").glob("*.yml"))),
+    entries = sorted((doc_dir / "log" / "work_meet").glob("*.yml"))
+    # fragments are also stale once the code rendering them changes
+    code_mtime = max(p.stat().st_mtime for p in file_dir.glob("*.py"))
+    stale = [entry for entry in entries if is_stale(entry, code_mtime)]
+    logger.info(f"Rendering {len(stale)} of {len(entries)} logbook entries")
+
+    if stale:
+        # caption every uncaptioned image up front so the model runs in batches
+        images = [
+            match.group(1)
+            for entry in stale
+            for match in UNCAPTIONED_IMAGE.finditer(entry.read_text())
+        ]
+        image_hashes = precompute_image_hashes(images)
+        caption_images(images)
+        pandoc_server()
+        # spawn, as the parent may hold CUDA and sqlite state that must not be forked
+        with ProcessPoolExecutor(
+            max_workers=os.cpu_count(),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=load_image_hashes,
+            initargs=(image_hashes,),
+        ) as executor:
+            for _ in tqdm(
+                executor.map(render_fragment, stale),
+                total=len(stale),
                 desc="Rendering logbook",
-            )
-        ):
-            pbar.set_postfix_str(entry.stem)
-            f.write(render_work_meet(entry) + "\n\n")
+            ):
+                pass
+
+    with open(logbook, "w") as f:
+        for entry in entries:
+            with open(fragment_path(entry)) as fragment:
+                shutil.copyfileobj(fragment, f)
+            f.write("\n\n")
 
 
 if __name__ == "__main__":
@@ -1,4 +1,11 @@
+import atexit
+import functools
+import http.client
 import logging
+import os
+import socket
+import subprocess
+import time
 from pathlib import Path
 
 import appdirs
@@ -12,7 +19,56 @@ template_dir = file_dir / "template"
 doc_dir = file_dir.parent
 build_dir = doc_dir / "build"
 image_dir = doc_dir / "images"
+# fragments belong to the checkout they were rendered from
+fragment_dir = build_dir / "fragments"
 cache_dir = Path(appdirs.user_cache_dir("ftc-docs"))
 
-for dir in (cache_dir, image_dir, build_dir):
+for dir in (cache_dir, image_dir, build_dir, fragment_dir):
     dir.mkdir(exist_ok=True, parents=True)
+
+
+@functools.cache
+def pandoc_server(timeout: float = 10) -> int | None:
+    """
+    Start a resident pandoc server and return its port, or None if unavailable.
+    The port (0 if unavailable) is exported to the environment so worker
+    processes share the outcome of their parent.
+    """
+
+    if (port := os.environ.get("FTC_DOCS_PANDOC_PORT")) is not None:
+        return int(port) or None
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        port = s.getsockname()[1]
+    # pandoc>=3 has a `server` subcommand, older releases ship `pandoc-server`
+    for cmd in (["pandoc", "server"], ["pandoc-server"]):
+        try:
+            proc = subprocess.Popen(
+                [*cmd, f"--port={port}"],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        except FileNotFoundError:
+            continue
+        deadline = time.monotonic() + timeout
+        while proc.poll() is None and time.monotonic() < deadline:
+            # a real request, as some builds accept connections then reset them
+            conn = http.client.HTTPConnection("localhost", port, timeout=1)
+            try:
+                conn.request("GET", "/version")
+                ok = conn.getresponse().status == 200
+            except (OSError, http.client.HTTPException):
+                ok = False
+            finally:
+                conn.close()
+            if not ok:
+                time.sleep(0.05)
+                continue
+            atexit.register(proc.terminate)
+            os.environ["FTC_DOCS_PANDOC_PORT"] = str(port)
+            logger.info(f"Started pandoc server on port {port}")
+            return port
+        proc.kill()
+    logger.warning("Unable to start pandoc server, falling back to subprocesses")
+    os.environ["FTC_DOCS_PANDOC_PORT"] = "0"
+    return None
@@ -1,16 +1,70 @@
 import functools
+import http.client
+import io
+import json
+import re
+import sqlite3
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import md5
+from typing import Iterable
 
-import PIL.Image
 from globals import *
-from panflute import *
-from yaml import Dumper, Loader, dump, load
 
+# Rendered as a raw LaTeX block so it passes through pandoc (and the filter)
+# verbatim and can be split on afterwards.
+_BATCH_TOKEN = "% SPLIT_CD985272F78311"
 
-def md2tex(md: str):
+
+def _pandoc_request(port: int, text: str, from_: str, to: str) -> str:
     """
-    Use pandoc to convert markdown to latex
+    Convert text with the resident pandoc server
+    """
+
+    conn = http.client.HTTPConnection("localhost", port)
+    try:
+        conn.request(
+            "POST",
+            "/",
+            body=json.dumps({"text": text, "from": from_, "to": to}),
+            headers={
+                "Content-Type": "application/json",
+                "Accept": "application/json",
+            },
+        )
+        response = conn.getresponse()
+        body = response.read().decode("utf-8")
+    finally:
+        conn.close()
+    result = json.loads(body) if response.status == 200 else {"error": body}
+    if "error" in result:
+        logger.error("Pandoc server error:")
+        logger.error(result["error"])
+        raise RuntimeError(f"Pandoc server failed to convert {from_} to {to}")
+    return result["output"]
+
+
+def _convert_with_server(port: int, md: str) -> str:
+    """
+    Use the pandoc server to convert markdown to latex, running the filter
+    in-process since the server does not support external filters
+    """
+
+    import panflute as pf
+
+    ast = _pandoc_request(port, md, "markdown", "json")
+    doc = pf.run_filter(filter, doc=pf.load(io.StringIO(ast)))
+    with io.StringIO() as f:
+        pf.dump(doc, f)
+        ast = f.getvalue()
+    return _pandoc_request(port, ast, "json", "latex")
+
+
+def _convert_with_subprocess(md: str) -> str:
+    """
+    Use a one-shot pandoc process to convert markdown to latex. Pandoc reads
+    its whole input before converting, so a process can't be kept alive and
+    fed several documents; batching amortizes the startup instead.
     """
 
     try:
@@ -38,6 +92,150 @@ def md2tex(md: str):
     return proc.stdout
 
 
+def _render_joined(mds: list[str]) -> list[str]:
+    """
+    Use a single pandoc conversion to convert a list of markdown to latex
+    """
+
+    if not mds:
+        return []
+    md = f"\n\n```{{=latex}}\n{_BATCH_TOKEN}\n```\n\n".join(mds)
+    tex = None
+    if (port := pandoc_server()) is not None:
+        try:
+            tex = _convert_with_server(port, md)
+        except (OSError, http.client.HTTPException) as e:
+            logger.warning(f"Pandoc server failed ({e!r}), falling back to subprocess")
+    if tex is None:
+        tex = _convert_with_subprocess(md)
+    results = [
+        fragment.strip("\n") + "\n" for fragment in tex.split(_BATCH_TOKEN + "\n")
+    ]
+    if len(results) != len(mds):
+        raise RuntimeError(
+            f"Expected {len(mds)} fragments from pandoc, got {len(results)}"
+        )
+    return results
+
+
+# reference link and footnote definitions are scoped to the whole pandoc
+# document, so fragments defining any are rendered on their own
+_DEFINITION = re.compile(r"^\s*\[[^\]]+\]:", re.MULTILINE)
+
+
+def _render_batch(mds: list[str]) -> list[str]:
+    """
+    Convert a list of markdown to latex, batching every fragment that can share
+    a pandoc document
+    """
+
+    shared = iter(_render_joined([md for md in mds if not _DEFINITION.search(md)]))
+    return [
+        _render_joined([md])[0] if _DEFINITION.search(md) else next(shared)
+        for md in mds
+    ]
+
+
+# anything pandoc could render as more than escaped text, including smart
+# quotes, dashes, ellipses and abbreviations, (fancy) list markers and code
+# blocks
+_MARKDOWN_SYNTAX = re.compile(
+    r"[*_`\[\]#\\|<>\"'~^@$&\n]|\.\.\.|--|^\s"
+    r"|^(?:[-+]|\(?(?:\d+|[A-Za-z]|[ivxlcdmIVXLCDM]+)[.)])\s"
+    r"|\b(?:Mrs?|Ms|Capt|Dr|Prof|Gen|Gov|e\.g|i\.e|Sgt|St|vol|vs|Sen|Rep|Pres|Hon"
+    r"|Rev|Ph\.D|M\.[AD]|pp?|ch|sec|cf|cp)\.\s"
+)
+_LATEX_ESCAPES = str.maketrans(
+    {
+        "&": r"\&",
+        "%": r"\%",
+        "$": r"\$",
+        "#": r"\#",
+        "_": r"\_",
+        "{": r"\{",
+        "}": r"\}",
+        "~": r"\textasciitilde{}",
+        "^": r"\^{}",
+        "\\": r"\textbackslash{}",
+    }
+)
+
+
+def _latex_escape(text: str) -> str:
+    return text.translate(_LATEX_ESCAPES)
+
+
+UNCAPTIONED_IMAGE = re.compile(r"!\[\s*\]\(\s*<?([^\s)>]+)")
+
+md2tex_cache_path = cache_dir / "md2tex.sqlite"
+# mixed into every key so that changes to the filter invalidate the cache
+_source_hash = md5(Path(__file__).read_bytes()).hexdigest()
+
+
+@functools.cache
+def get_md2tex_cache() -> sqlite3.Connection:
+    conn = sqlite3.connect(md2tex_cache_path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS md2tex (hash TEXT PRIMARY KEY, latex TEXT NOT NULL)"
+    )
+    return conn
+
+
+def _fragment_key(md: str) -> str:
+    # generated captions end up in the latex, so the content of every
+    # uncaptioned image is part of the key as well
+    images = "".join(
+        get_image_hash(image_path) if image_path.exists() else "missing"
+        for image_path in map(resolve_image, UNCAPTIONED_IMAGE.findall(md))
+    )
+    return md5((_source_hash + md + images).encode()).hexdigest()
+
+
+def md2tex_batch(mds: list[str]) -> list[str]:
+    """
+    Convert a list of markdown to latex, only running pandoc on the fragments
+    missing from the cache
+    """
+
+    keys = list(map(_fragment_key, mds))
+    # plain prose needs no pandoc, only escaping
+    cached = {
+        key: _latex_escape(md.rstrip()) + "\n"
+        for key, md in zip(keys, mds)
+        if not _MARKDOWN_SYNTAX.search(md.rstrip())
+    }
+    if lookup := [key for key in keys if key not in cached]:
+        cache = get_md2tex_cache()
+        cached |= dict(
+            cache.execute(
+                f"SELECT hash, latex FROM md2tex WHERE hash IN ({', '.join('?' * len(lookup))})",
+                lookup,
+            )
+        )
+    if misses := {key: md for key, md in zip(keys, mds) if key not in cached}:
+        rendered = dict(zip(misses, _render_batch(list(misses.values()))))
+        with cache:
+            cache.executemany(
+                "INSERT OR REPLACE INTO md2tex VALUES (?, ?)", rendered.items()
+            )
+        cached |= rendered
+    return [cached[key] for key in keys]
+
+
+def md2tex(md: str) -> str:
+    """
+    Use pandoc to convert markdown to latex
+    """
+
+    return md2tex_batch([md])[0]
+
+
+# kept constant so the compiled graph shapes stay stable
+CAPTION_MAX_LENGTH = 16
+CAPTION_NUM_BEAMS = 4
+CAPTION_BATCH_SIZE = 16
+
+
 @functools.cache
 def get_models():
     import torch
@@ -54,120 +252,290 @@ def get_models():
     )
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     model.to(device)
+    if device.type == "cuda":
+        model.half()
+    # both need recent torch/transformers, the eager model still works without
+    if getattr(model.decoder, "_supports_static_cache", False):
+        model.generation_config.cache_implementation = "static"
+    # CUDA graphs only pay off on the GPU, on the CPU compiling costs more than
+    # it saves for a handful of images
+    if device.type == "cuda" and hasattr(torch, "compile"):
+        logger.info("Compiling model")
+        model.forward = torch.compile(model.forward, mode="reduce-overhead")
+        model.caption_compiled = True
+        generate(
+            model,
+            torch.zeros(
+                CAPTION_BATCH_SIZE, 3, 224, 224, dtype=model.dtype, device=device
+            ),
+        )
     return model, feature_extractor, tokenizer, device
 
 
-caption_cache_path = cache_dir / "captions.yaml"
-caption_cache_path.touch(exist_ok=True)
+def generate(model, pixel_values):
+    """
+    Run the caption model without autograd and under mixed precision
+    """
 
+    import torch
 
-@functools.cache
-def get_caption_cache() -> dict:
-    with open(caption_cache_path) as f:
-        return load(f.read() or "{}", Loader=Loader)
+    device = pixel_values.device
+    count = len(pixel_values)
+    if getattr(model, "caption_compiled", False) and count < CAPTION_BATCH_SIZE:
+        # pad to the batch shape the compiled model was warmed up with
+        padding = pixel_values[-1:].expand(
+            CAPTION_BATCH_SIZE - count, *pixel_values.shape[1:]
+        )
+        pixel_values = torch.cat([pixel_values, padding])
+    dtype = torch.float16 if device.type == "cuda" else torch.bfloat16
+    with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=dtype):
+        return model.generate(
+            pixel_values, max_length=CAPTION_MAX_LENGTH, num_beams=CAPTION_NUM_BEAMS
+        )[:count]
 
 
-def write_caption_cache(caption_cache: dict):
-    with open(caption_cache_path, "w") as f:
-        f.write(dump(caption_cache, Dumper=Dumper))
+caption_cache_path = cache_dir / "captions.sqlite"
+legacy_caption_cache_path = cache_dir / "captions.yaml"
 
 
 @functools.cache
-def get_caption(image_path: str) -> str:
-    image_path = Path(image_path)
-    if not image_path.is_absolute():
-        image_path = image_dir / image_path
-    if not image_path.exists():
-        logger.warning(f"Image {image_path} does not exist")
-        return ""
-    image = PIL.Image.open(image_path)
+def get_caption_cache() -> sqlite3.Connection:
+    conn = sqlite3.connect(caption_cache_path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS captions (hash TEXT PRIMARY KEY, caption TEXT NOT NULL)"
+    )
+    if legacy_caption_cache_path.exists():
+        from yaml import SafeLoader, load
 
-    hash = md5(image_path.read_bytes()).hexdigest()
-    caption_cache = get_caption_cache()
-    if (caption := caption_cache.get(hash)) is not None:
-        return caption
+        with open(legacy_caption_cache_path) as f:
+            captions = load(f, Loader=SafeLoader) or {}
+        logger.info(f"Importing {len(captions)} captions from {f.name}")
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO captions VALUES (?, ?)", captions.items()
+            )
+        legacy_caption_cache_path.rename(
+            legacy_caption_cache_path.with_suffix(".yaml.imported")
+        )
+    return conn
 
-    model, feature_extractor, tokenizer, device = get_models()
+
+def open_image(image_path: Path) -> "PIL.Image.Image":
+    import PIL.Image
+
+    image = PIL.Image.open(image_path)
+    # let JPEG decode straight at the model's input resolution
+    image.draft("RGB", (224, 224))
+    # PIL decodes lazily, force it here so it happens on the caller's thread
+    image.load()
     if image.mode != "RGB":
         image = image.convert(mode="RGB")
+    return image
+
+
+def generate_captions(images: list["PIL.Image.Image"]) -> list[str]:
+    """
+    Caption a batch of images with a single forward pass
+    """
+
+    model, feature_extractor, tokenizer, device = get_models()
     pixel_values = feature_extractor(
-        images=[image], return_tensors="pt"
-    ).pixel_values.to(device)
+        images=images, return_tensors="pt"
+    ).pixel_values.to(device, dtype=model.dtype)
     predictions = tokenizer.batch_decode(
-        model.generate(pixel_values, max_length=16, num_beams=4),
+        generate(model, pixel_values),
         skip_special_tokens=True,
     )
-    caption_cache[hash] = (caption := predictions[0].strip())
-    write_caption_cache(caption_cache)
+    return [prediction.strip() for prediction in predictions]
+
+
+def resolve_image(image_path: str) -> Path:
+    image_path = Path(image_path)
+    if not image_path.is_absolute():
+        image_path = image_dir / image_path
+    return image_path.resolve()
+
+
+image_hashes: dict[Path, str] = {}
+
+
+def hash_file(path: Path) -> str:
+    hash = md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            hash.update(chunk)
+    return hash.hexdigest()
+
+
+def get_image_hash(image_path: Path) -> str:
+    if (hash := image_hashes.get(image_path)) is None:
+        hash = image_hashes[image_path] = hash_file(image_path)
+    return hash
+
+
+def precompute_image_hashes(image_paths: Iterable[str]) -> dict[Path, str]:
+    """
+    Hash every existing image concurrently, remembering the results for later
+    lookups
+    """
+
+    paths = {p for p in map(resolve_image, image_paths) if p.exists()}
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        image_hashes.update(zip(paths, executor.map(hash_file, paths)))
+    return image_hashes
+
+
+def load_image_hashes(hashes: dict[Path, str]):
+    """
+    Seed the hashes precomputed by another process
+    """
+
+    image_hashes.update(hashes)
+
+
+@functools.cache
+def get_captions() -> dict[str, str]:
+    """
+    Load the caption cache into memory, keyed by image content hash
+    """
+
+    return dict(get_caption_cache().execute("SELECT hash, caption FROM captions"))
+
+
+def store_captions(captions: dict[str, str]):
+    get_captions().update(captions)
+    caption_cache = get_caption_cache()
+    with caption_cache:
+        caption_cache.executemany(
+            "INSERT OR REPLACE INTO captions VALUES (?, ?)", captions.items()
+        )
+
+
+def caption_images(image_paths: Iterable[str], batch_size: int = CAPTION_BATCH_SIZE):
+    """
+    Generate and cache the captions of every uncached image, batch by batch
+    """
+
+    captions = get_captions()
+    pending: dict[str, Path] = {}
+    for image_path in map(resolve_image, image_paths):
+        if not image_path.exists():
+            continue
+        if (hash := get_image_hash(image_path)) not in captions:
+            pending.setdefault(hash, image_path)
+
+    hashes = list(pending)
+    for i in range(0, len(hashes), batch_size):
+        batch = hashes[i : i + batch_size]
+        logger.info(f"Captioning {len(batch)} images")
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            images = list(executor.map(open_image, (pending[h] for h in batch)))
+        store_captions(dict(zip(batch, generate_captions(images))))
+
+
+@functools.cache
+def get_caption(image_path: str) -> str:
+    image_path = resolve_image(image_path)
+    if not image_path.exists():
+        logger.warning(f"Image {image_path} does not exist")
+        return ""
+
+    # identical images share a caption whatever their path
+    hash = get_image_hash(image_path)
+    if (caption := get_captions().get(hash)) is None:
+        (caption,) = generate_captions([open_image(image_path)])
+        store_captions({hash: caption})
     return caption
 
 
+# use minted
+def _handle_code(e, doc, language: str):
+    import panflute as pf
+
+    prefix = f"\\mintinline{{{language}}}"
+    text = e.text
+    if "!" not in text:
+        prefix += "!" + text + "!"
+    elif "|" not in text:
+        prefix += "|" + text + "|"
+    elif text.count("{") == text.count("}"):
+        prefix += "{" + text + "}"
+    else:
+        raise RuntimeError(f'Unable to parse code block "{text}"')
+    return pf.RawInline(prefix, format="latex")
+
+
+def _handle_code_block(e, doc, language: str):
+    import panflute as pf
+
+    try:
+        language = e.classes[0]
+    except IndexError:
+        language = language
+    return pf.RawBlock(
+        (f"\\begin{{minted}}{{{language}}}\n" f"{e.text}\n" f"\\end{{minted}}"),
+        format="latex",
+    )
+
+
+# image
+def _handle_image(e, doc, language: str):
+    import panflute as pf
+
+    caption: str = pf.stringify(e.content).strip().capitalize()
+    if not caption:
+        logger.warning(f"Image {e.url} has no caption")
+        caption = get_caption(e.url).capitalize()
+        logger.info(f"Generated caption: {caption}")
+    label = e.attributes.get("label", "")
+    label = "\\label{" + label + "}" if label else ""
+    formats = ""
+
+    attributes = {k: v.strip().removesuffix(",") for k, v in e.attributes.items()}
+    if (width := attributes.get("width")) is not None:
+        if width.endswith("%"):
+            width = int(width.removesuffix("%")) / 100
+            width = f"{width}\\linewidth"
+        formats += f"width={width},"
+    if (height := attributes.get("height")) is not None:
+        if height.endswith("%"):
+            height = int(height.removesuffix("%")) / 100
+            height = f"{height}\\textheight"
+        formats += f"height={height},"
+    formats = formats.removesuffix(",")
+    if formats:
+        formats = f"[{formats}]"
+
+    return pf.RawInline(
+        (
+            f"\\begin{{figure}}[H]\n"
+            f"\\centering\n"
+            f"\\img{formats}{{{e.url}}}\n"
+            f"\\caption{{{caption}}}{label}\n"
+            f"\\end{{figure}}"
+        ),
+        format="latex",
+    )
+
+
+# dispatch on the element type name so the common elements fall through on a
+# single dict miss
+_HANDLERS = {
+    "Code": _handle_code,
+    "CodeBlock": _handle_code_block,
+    "Image": _handle_image,
+}
+
+
 def filter(e, doc, language: str = "cpp"):
-    match e:
-        # use minted
-        case Code():
-            prefix = f"\\mintinline{{{language}}}"
-            text = e.text
-            if "!" not in text:
-                prefix += "!" + text + "!"
-            elif "|" not in text:
-                prefix += "|" + text + "|"
-            elif text.count("{") == text.count("}"):
-                prefix += "{" + text + "}"
-            else:
-                raise RuntimeError(f'Unable to parse code block "{text}"')
-            return RawInline(prefix, format="latex")
-        case CodeBlock():
-            try:
-                language = e.classes[0]
-            except IndexError:
-                language = language
-            return RawBlock(
-                (f"\\begin{{minted}}{{{language}}}\n" f"{e.text}\n" f"\\end{{minted}}"),
-                format="latex",
-            )
-        # image
-        case Image():
-            caption: str = stringify(e.content).strip().capitalize()
-            if not caption:
-                logger.warning(f"Image {e.url} has no caption")
-                caption = get_caption(e.url).capitalize()
-                logger.info(f"Generated caption: {caption}")
-            label = e.attributes.get("label", "")
-            label = "\\label{" + label + "}" if label else ""
-            formats = ""
-
-            attributes = {
-                k: v.strip().removesuffix(",") for k, v in e.attributes.items()
-            }
-            if (width := attributes.get("width")) is not None:
-                if width.endswith("%"):
-                    width = int(width.removesuffix("%")) / 100
-                    width = f"{width}\\linewidth"
-                formats += f"width={width},"
-            if (height := attributes.get("height")) is not None:
-                if height.endswith("%"):
-                    height = int(height.removesuffix("%")) / 100
-                    height = f"{height}\\textheight"
-                formats += f"height={height},"
-            formats = formats.removesuffix(",")
-            if formats:
-                formats = f"[{formats}]"
-
-            return RawInline(
-                (
-                    f"\\begin{{figure}}[H]\n"
-                    f"\\centering\n"
-                    f"\\img{formats}{{{e.url}}}\n"
-                    f"\\caption{{{caption}}}{label}\n"
-                    f"\\end{{figure}}"
-                ),
-                format="latex",
-            )
+    if (handler := _HANDLERS.get(type(e).__name__)) is not None:
+        return handler(e, doc, language)
 
 
 def main(doc=None):
-    return run_filter(filter, doc=doc)
+    import panflute as pf
+
+    return pf.run_filter(filter, doc=doc)
 
 
 if __name__ == "__main__":